@@ -1,23 +1,27 @@
 #!/usr/bin/python
 
-import yaml
-import time
+import json
 import sys
-from emoji import demojize
-from unidecode import unidecode
+
+from text_utils import orjson, fast_demojize, fast_unidecode, format_log_time
+
 
 if len(sys.argv) < 2:
     print("Usage: %s [path/to/message.json]" % sys.argv[0])
     exit(1)
 
-MESSAGES = open(sys.argv[1], 'r').read()
-PARSED_MESSAGE_BLOB = yaml.safe_load(MESSAGES)
+with open(sys.argv[1], 'rb') as message_file:
+    PARSED_MESSAGE_BLOB = (orjson or json).loads(message_file.read())
 INORDER_MESSAGES = reversed(PARSED_MESSAGE_BLOB['messages'])
 
 for message in INORDER_MESSAGES:
-    time_string = time.strftime('[%Y-%m-%d %H:%M:%S]', time.localtime(int(message['timestamp_ms']) / 1000.0))
-    message_string = demojize(message['content'].encode('latin-1').decode('utf-8'))
+    time_string = format_log_time(int(message['timestamp_ms']) // 1000)
+    message_string = message['content']
+    # Facebook writes UTF-8 bytes out as latin-1 codepoints. Plain ASCII text is the same either way,
+    # and since emoji are never ASCII either, most messages can skip both the fixup and demojize.
+    if not message_string.isascii():
+        message_string = fast_demojize(message_string.encode('latin-1').decode('utf-8'))
     if message['type'] == 'Share':
         message_string = message['share']['link']
     outstring = u"{} {}: {}".format(time_string, message['sender_name'], message_string)
-    print(unidecode(outstring))
\ No newline at end of file
+    print(fast_unidecode(outstring))
\ No newline at end of file
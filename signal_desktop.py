@@ -6,25 +6,50 @@ import argparse
 import tempfile
 import sqlite3
 import shutil
+import errno
 import json
-import time
 import sys
 import os
 import re
 
-from distutils.spawn import find_executable
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
-from hashlib import md5
+from functools import lru_cache, partial
+from itertools import groupby
+from operator import itemgetter
+from hashlib import blake2b
 from pathlib import Path
+from shutil import which
 from datetime import datetime
 from typing import Iterable
 from packaging import version
 
-from unidecode import unidecode
 from slugify import slugify
 from emoji import demojize
 
+from text_utils import orjson, fast_demojize, fast_unidecode, format_log_time
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where we just don't try to reflink
+    fcntl = None
+
+try:
+    from sqlcipher3 import dbapi2 as sqlcipher
+except ImportError:
+    try:
+        from pysqlcipher3 import dbapi2 as sqlcipher
+    except ImportError:
+        # Without the bindings we fall back to decrypting a copy of the database with the sqlcipher executable
+        sqlcipher = None
+
 DEBUG = False
+# Number of log lines to accumulate before handing them to the output file in one call
+WRITE_BATCH_SIZE = 4096
+OUTPUT_BUFFER_SIZE = 1 << 20
+# Number of conversations whose messages are fetched together in a single query
+CONVO_BATCH_SIZE = 32
 
 if sys.platform.startswith('win32'):
     APPDATA = os.getenv('APPDATA')
@@ -40,16 +65,8 @@ else:
     DB_PATH = os.path.expanduser('~/.config/Signal/sql/db.sqlite')
     ATTACHMENT_PATH = os.path.expanduser('~/.config/Signal/attachments.noindex')
 
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
-
-
 @contextmanager
-def open_db(key, db_path):
-    connection = None
+def decrypt_db(key, db_path):
     tmpfd = None
     tmpfilename = None
 
@@ -62,104 +79,185 @@ def open_db(key, db_path):
         tmpfd, tmpfilename = tempfile.mkstemp()
         os.close(tmpfd)
         tmpfd = None
-        decryption_cmd = ['sqlcipher',
-                          db_path,
-                          decryption_sql.format(key, tmpfilename)]
-        subprocess.check_call(decryption_cmd)
-
-        connection = sqlite3.connect(tmpfilename)
-        connection.row_factory = dict_factory
-        cur = connection.cursor()
-        cur.execute("""PRAGMA key="x'%s'";""" % key)
-        yield cur
+        # Feed the SQL through stdin rather than argv so the key doesn't show up in the process list.
+        # sqlcipher reads it as UTF-8 whatever the locale, which matters for a temp path under a non-ASCII user name
+        subprocess.run(['sqlcipher', db_path], input=decryption_sql.format(key, tmpfilename),
+                       encoding='utf-8', check=True)
+        yield tmpfilename
     finally:
-        if connection:
-            connection.close()
         if tmpfd:
             os.close(tmpfd)
         if tmpfilename and os.path.isfile(tmpfilename):
             os.unlink(tmpfilename)
 
 
-# Adapted from https://stackoverflow.com/a/54278929
-def read_lines_from_end(filename: Path) -> Iterable[str]:
-    with filename.open('rb') as f:
-        try:  # catch OSError in case of a one line file
-            f.seek(-2, os.SEEK_END)
-            while True:
-                while f.read(1) != b'\n':
-                    f.seek(-2, os.SEEK_CUR)
-                curpos = f.tell()
-                yield f.readline().decode()
-                # Jump back to just before the newline we read
-                f.seek(curpos-2)
-        except OSError:
-            f.seek(0)
-            yield f.readline().decode()
+def connect_db(db_filename, key=None, read_only=False):
+    if key is None and read_only:
+        # Nothing modifies the decrypted copy while it's being read, so SQLite can skip locking it entirely
+        connection = sqlite3.connect(f"{Path(db_filename).as_uri()}?mode=ro&immutable=1", uri=True)
+        connection.row_factory = sqlite3.Row
+    elif key is None:
+        connection = sqlite3.connect(db_filename)
+        # The decrypted copy is a throwaway file, so there's no need to journal or sync anything
+        connection.execute("PRAGMA journal_mode=OFF")
+        connection.execute("PRAGMA synchronous=OFF")
+        # This is the connection that builds the index, which sorts the whole messages table.
+        # Readers keep the default cache, since they see each page about once and there's one per core.
+        connection.execute("PRAGMA cache_size=-262144")
+        connection.row_factory = sqlite3.Row
+    else:
+        if read_only:
+            # Signal's own database may be in use, so it can't be opened immutable, but read-only at least
+            # means closing the connection never checkpoints the WAL, which would write to the user's database
+            connection = sqlcipher.connect(f"{Path(db_filename).as_uri()}?mode=ro", uri=True)
+        else:
+            connection = sqlcipher.connect(db_filename)
+        connection.execute("""PRAGMA key="x'%s'";""" % key)
+        connection.row_factory = sqlcipher.Row
+    connection.execute("PRAGMA temp_store=MEMORY")
+    connection.execute("PRAGMA mmap_size=1073741824")
+    return connection
+
+
+@contextmanager
+def open_db(key, db_path):
+    # Yields the connect_db arguments for reading the database: the encrypted original when
+    # SQLCipher bindings are available, or a decrypted temporary copy otherwise
+    if sqlcipher is not None:
+        yield db_path, key
+    else:
+        with decrypt_db(key, db_path) as plaintext_db:
+            yield plaintext_db, None
 
 
-TIMESTAMP_PATTERN = re.compile(r'^\[(?P<timestamp>[0-9: -]*)]')
+# Size of the chunks read_lines_from_end walks backwards through a file in
+READ_BLOCK_SIZE = 8192
 
 
-def read_last_timestamp(filename: Path) -> float:
+def read_lines_from_end(filename: Path) -> Iterable[str]:
+    with filename.open('rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        if position:
+            # Don't report the empty "line" after a trailing newline
+            f.seek(position - 1)
+            if f.read(1) == b'\n':
+                position -= 1
+        remainder = b''
+        while position > 0:
+            read_size = min(READ_BLOCK_SIZE, position)
+            position -= read_size
+            f.seek(position)
+            lines = (f.read(read_size) + remainder).split(b'\n')
+            # The first piece may continue in the block before this one, so hold it back until that's read
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                yield line.decode()
+        yield remainder.decode()
+
+
+TIMESTAMP_PATTERN = re.compile(r'^\[(?P<timestamp>[0-9: -]*)]', re.MULTILINE)
+# How much of the end of a log file to check for a timestamp before scanning back through the whole thing
+TAIL_READ_SIZE = 4096
+
+
+def find_last_timestamp_match(filename: Path):
+    with filename.open('rb') as f:
+        start = max(0, f.seek(0, os.SEEK_END) - TAIL_READ_SIZE)
+        f.seek(start)
+        tail = f.read()
+    if start:
+        # The first line most likely began before the bytes we read, so it can't be trusted
+        newline = tail.find(b'\n')
+        tail = tail[newline + 1:] if newline != -1 else b''
+    match = None
+    for match in TIMESTAMP_PATTERN.finditer(tail.decode()):
+        pass
+    if match:
+        return match
     for line in read_lines_from_end(filename):
         match = TIMESTAMP_PATTERN.search(line)
         if match:
-            return datetime.strptime(match.group('timestamp'), "%Y-%m-%d %H:%M:%S").timestamp()
+            return match
+    return None
+
+
+def read_last_timestamp(filename: Path) -> float:
+    match = find_last_timestamp_match(filename)
+    if match:
+        return datetime.strptime(match.group('timestamp'), "%Y-%m-%d %H:%M:%S").timestamp()
     # If we didn't find any timestamp, error
     raise ValueError(f"No timestamp found in file {filename}")
 
 
+# Names in Signal now use these direction indicators, so we need to remove them or they'll confuse our unidecode
+DIRECTION_INDICATORS = str.maketrans('', '', '\u2068\u2069')
+
+
 def make_name(record):
-    name = str(record["id"])
-    if record["name"]:
-        name = record["name"]
-    elif record["profileName"]:
-        name = "~" + record["profileName"]
-    elif record["type"] == "group":
-        name = "Unknown group"
-    # Names in Signal now use these direction indicators, so we need to remove them or they'll confuse our unidecode
-    chars_to_remove = ['\u2068', '\u2069']
-    return name.translate({ord(c): None for c in chars_to_remove})
+    name = record["name"]
+    if not name:
+        profile_name = record["profileName"]
+        if profile_name:
+            name = "~" + profile_name
+        elif record["type"] == "group":
+            name = "Unknown group"
+        else:
+            name = str(record["id"])
+    return name.translate(DIRECTION_INDICATORS)
+
+
+def make_time_string(timestamp_ms):
+    return format_log_time(int(timestamp_ms) // 1000)
+
+
+def format_attachments(attachments):
+    if not attachments:
+        return ''
+    # A list rather than a generator, since str.join would have to build one from the generator anyway
+    return "[Attachment(s): %s] " % ", ".join(
+        [f"{x.get('fileName') or x['contentType']}({x.get('path', 'N/A')})" for x in attachments])
+
+
+def format_incoming(id_list, outgoing_name, message):
+    name = id_list.get(message.get("source") or message.get("sourceUuid"), "Unknown")
+    return name, format_attachments(message["attachments"]) + fast_demojize(message.get('body') or "")
+
+
+def format_outgoing(id_list, outgoing_name, message):
+    return outgoing_name, format_attachments(message["attachments"]) + fast_demojize(message.get('body') or "")
+
+
+def format_keychange(id_list, outgoing_name, message):
+    return id_list.get(message.get("key_changed", ''), "Unknown"), "[Safety number changed]"
+
+
+def format_verified_change(id_list, outgoing_name, message):
+    name = id_list.get(message["verifiedChanged"], "Unknown")
+    return name, "[Contact verification status set to %s]" % message["verified"]
+
+
+# Maps each message type to a function returning the (name, body) to log for it
+MESSAGE_FORMATTERS = {
+    "incoming": format_incoming,
+    "outgoing": format_outgoing,
+    "keychange": format_keychange,
+    "verified-change": format_verified_change,
+}
 
 
 def make_text_log(id_list, outgoing_name, message):
-    message_time = time.localtime(int(message.get('received_at_ms', message['received_at'])) / 1000.0)
-    time_string = time.strftime('[%Y-%m-%d %H:%M:%S]', message_time)
-
-    message_type = message.get("type", "unknown")
-    if message_type == "incoming":
-        message_id = message.get("source", None) or message.get("sourceUuid", None)
-        name = id_list[message_id] if message_id else "Unknown"
-        if message["attachments"]:
-            attach_message = "[Attachment(s): %s] " % ", ".join(
-                ["%s(%s)" % (x.get("fileName", None) or x["contentType"], x.get("path", "N/A")) for x in message["attachments"]])
-        else:
-            attach_message = ''
-        body = attach_message + demojize(message.get('body') or "")
-    elif message_type == "outgoing":
-        name = outgoing_name
-        if message["attachments"]:
-            attach_message = "[Attachment(s): %s] " % ", ".join(
-                ["%s(%s)" % (x.get("fileName", None) or x["contentType"], x.get("path", "N/A")) for x in message["attachments"]])
-        else:
-            attach_message = ''
-        body = attach_message + demojize(message.get('body') or "")
-    elif message_type == "keychange":
-        name = id_list.get(message.get("key_changed", ''), "Unknown")
-        body = "[Safety number changed]"
-    elif message_type == "verified-change":
-        name = id_list.get(message["verifiedChanged"], "Unknown")
-        body = "[Contact verification status set to %s]" % message["verified"]
-    else:
+    formatter = MESSAGE_FORMATTERS.get(message.get("type", "unknown"))
+    if formatter is None:
         if DEBUG:
             print("Error: message with unknown type")
             print("Message contents:")
             print(json.dumps(message, indent=4))
         return None
 
+    time_string = make_time_string(message.get('received_at_ms') or message['received_at'])
+    name, body = formatter(id_list, outgoing_name, message)
     outstring = u"{} {}: {}".format(time_string, name, body)
-    return unidecode(outstring)
+    return fast_unidecode(outstring)
 
 
 def ensure_dir(dirname):
@@ -170,10 +268,96 @@ def ensure_dir(dirname):
             raise
 
 
-def copy_attachments(attachment_path, output_dir, message):
-    atch_out_dir = Path(output_dir) / "attachments"
-    atch_out_dir.mkdir(parents=True, exist_ok=True)
-    for atch in message.get("attachments", []):
+# Largest chunk handed to a single copy_file_range/sendfile call, and the buffer size for the plain copy fallback
+COPY_CHUNK_SIZE = 1 << 30
+COPY_BUFFER_SIZE = 256 * 1024
+# Errors meaning the kernel or filesystem can't do an in-kernel copy between these two files
+UNSUPPORTED_COPY_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+# In-kernel copy methods, best first. Each copies from the current offset of the source fd and returns 0 at EOF.
+KERNEL_COPY_METHODS = []
+if hasattr(os, 'copy_file_range'):
+    KERNEL_COPY_METHODS.append(lambda src_fd, dest_fd: os.copy_file_range(src_fd, dest_fd, COPY_CHUNK_SIZE))
+if sys.platform.startswith('linux'):
+    KERNEL_COPY_METHODS.append(lambda src_fd, dest_fd: os.sendfile(dest_fd, src_fd, None, COPY_CHUNK_SIZE))
+
+
+def copy_file(src, dest):
+    # Same result as shutil.copy2, but lets the kernel move the data (or reflink it on CoW filesystems)
+    if not KERNEL_COPY_METHODS:
+        shutil.copy2(src, dest)
+        return
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        src_size = os.fstat(fsrc.fileno()).st_size
+        for kernel_copy in KERNEL_COPY_METHODS:
+            try:
+                if not kernel_copy(fsrc.fileno(), fdst.fileno()) and src_size:
+                    # Some filesystems return 0 instead of an error when they can't do the copy,
+                    # so nothing copied from a non-empty file means try the next method, not EOF
+                    continue
+                while kernel_copy(fsrc.fileno(), fdst.fileno()):
+                    pass
+                break
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_COPY_ERRNOS:
+                    raise
+                # Start the next method over from scratch in case this one got partway through
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        else:
+            shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+    shutil.copystat(src, dest)
+
+
+# Linux ioctl that makes one file share another's data blocks on copy-on-write filesystems (btrfs, XFS)
+FICLONE = 0x40049409
+
+
+def clone_file(src, dest):
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dest)
+
+
+def link_or_copy_file(src, dest):
+    # Attachments are never modified in place, so a hardlink (or failing that, a reflink) is as good as a copy
+    if os.path.lexists(dest):
+        if os.path.samefile(src, dest):
+            return
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+        return
+    except OSError:
+        pass
+    if fcntl is not None:
+        try:
+            clone_file(src, dest)
+            return
+        except OSError:
+            pass
+    copy_file(src, dest)
+
+
+@lru_cache(maxsize=128)
+def attachment_extension(content_type):
+    extension = mimetypes.guess_extension(content_type)
+    if not extension:
+        extension = "." + content_type.rpartition("/")[2]
+    if extension == ".jpe":
+        extension = ".jpg"
+    return extension
+
+
+def attachment_digest(atch):
+    # Only hash fields that never change for a given file, so reruns come up with the same name
+    stable_fields = f"{atch['path']}|{atch.get('contentType', '')}|{atch.get('size', '')}"
+    return blake2b(stable_fields.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def copy_attachments(attachment_path, atch_out_dir, message):
+    for atch in message.get("attachments") or []:
         # If we don't have a local copy of the file, we're done.
         if "path" not in atch.keys():
             continue
@@ -181,45 +365,112 @@ def copy_attachments(attachment_path, output_dir, message):
         if atch.get("fileName", None):
             filename = atch["fileName"]
         else:
-            extension = mimetypes.guess_extension(atch["contentType"])
-            if not extension:
-                extension = "." + atch["contentType"].split("/")[-1]
-            if extension == ".jpe":
-                extension = ".jpg"
+            extension = attachment_extension(atch["contentType"])
             identifier = (atch.get("attachment_identifier", None) or
                           atch.get("id", None) or
                           atch.get("cdnKey", None) or
-                          md5(str(atch).encode('utf-8')).hexdigest())
+                          attachment_digest(atch))
             filename = "%s%s" % (identifier, extension)
         src = Path(attachment_path) / atch["path"]
-        dest = Path(atch_out_dir) / filename
-        shutil.copy2(src, dest)
-
-
-def process_convo(cur, id_list, convo_map, convo_id, outgoing_name, process_attachments, attachment_path, base_output_dir):
-    convo_name = slugify(demojize(convo_map[convo_id]))
-    cur.execute("select json from messages where conversationId = ? order by sent_at asc", [convo_id])
-    convo_objs = [json.loads(x["json"]) for x in cur.fetchall()]
+        dest = atch_out_dir / filename
+        link_or_copy_file(src, dest)
+
+
+# The conversation columns main() and make_name read; uuid is missing from some schema versions
+CONVERSATION_COLUMNS = ("id", "e164", "uuid", "name", "profileName", "type")
+
+
+def read_conversations(cur):
+    cur.execute("select name from pragma_table_info('conversations');")
+    available = {row["name"] for row in cur.fetchall()}
+    columns = ", ".join(column for column in CONVERSATION_COLUMNS if column in available)
+    cur.execute(f"select {columns} from conversations;")
+    return [dict(row) for row in cur.fetchall()]
+
+
+# Only the fields make_text_log and copy_attachments read are pulled out of each message's JSON.
+# The body comes back as raw bytes so that unpaired surrogates survive the trip out of SQLite.
+MESSAGE_QUERY = """
+    select conversationId,
+           json_extract(json, '$.type') as type,
+           json_extract(json, '$.received_at') as received_at,
+           json_extract(json, '$.received_at_ms') as received_at_ms,
+           json_extract(json, '$.source') as source,
+           json_extract(json, '$.sourceUuid') as sourceUuid,
+           cast(json_extract(json, '$.body') as blob) as body,
+           json_extract(json, '$.attachments') as attachments,
+           json_extract(json, '$.key_changed') as key_changed,
+           json_extract(json, '$.verifiedChanged') as verifiedChanged,
+           json -> '$.verified' as verified
+    from messages where conversationId in ({})
+    order by conversationId, sent_at asc
+"""
+
+
+def load_message_json(raw_json):
+    if orjson is None:
+        return json.loads(raw_json)
+    try:
+        return orjson.loads(raw_json)
+    except orjson.JSONDecodeError:
+        # orjson rejects unpaired surrogate escapes, which truncated message bodies can contain
+        return json.loads(raw_json)
+
+
+def load_message_row(row):
+    message = dict(row)
+    if message["body"] is not None:
+        message["body"] = message["body"].decode('utf-8', 'surrogatepass')
+    if message["attachments"] is not None:
+        message["attachments"] = load_message_json(message["attachments"])
+    if message["verified"] is not None:
+        # Selected as JSON text, since json_extract would turn true/false into 1/0
+        message["verified"] = load_message_json(message["verified"])
+    return message
+
+
+def read_existing_log_times(output_dir, convo_name):
+    # Where each log file from a previous run left off, keyed by its month
+    last_times = {}
+    for out_filename in output_dir.glob(f"{convo_name}_????_??.txt"):
+        try:
+            last_times[out_filename.stem[-7:]] = read_last_timestamp(out_filename)
+        except ValueError:
+            print(f"WARNING: no timestamp found for pre-existing file {out_filename}")
+    return last_times
+
+
+def process_convo(rows, id_list, convo_name, outgoing_name, process_attachments, attachment_path, base_output_dir):
     current_file = None
     current_month = None
     current_time = 0
+    last_written_time = None
+    pending_lines = []
     output_dir = Path(base_output_dir) / convo_name
     output_dir.mkdir(parents=True, exist_ok=True)
-    for message in convo_objs:
-        message_timestamp = int(message.get('received_at_ms', message['received_at'])) / 1000.0
-        time_string = time.strftime('%Y_%m', time.localtime(message_timestamp))
+    atch_out_dir = output_dir / "attachments"
+    if process_attachments:
+        atch_out_dir.mkdir(exist_ok=True)
+    last_times = read_existing_log_times(output_dir, convo_name)
+    # Stream rows off the cursor rather than loading the whole conversation into memory
+    for row in rows:
+        message = load_message_row(row)
+        received_at = message.get('received_at_ms') or message['received_at']
+        message_timestamp = int(received_at) / 1000.0
+        # Reuse the cached log timestamp for the month, e.g. "[2020-09-13 12:44:30]" -> "2020_09"
+        log_time = make_time_string(received_at)
+        time_string = f"{log_time[1:5]}_{log_time[6:8]}"
         if time_string != current_month:
             if current_file:
+                current_file.writelines(pending_lines)
+                pending_lines.clear()
                 current_file.close()
-            out_filename = output_dir / f"{convo_name}_{time_string}.txt"
-            if out_filename.exists():
-                try:
-                    current_time = read_last_timestamp(out_filename)
-                except ValueError:
-                    # Only update our current time if we've successfully parsed the last time
-                    print(f"WARNING: no timestamp found for pre-existing file {out_filename}")
-                    pass
-            current_file = out_filename.open("a")
+                current_file = None
+            if last_written_time is not None:
+                last_times[current_month] = last_written_time
+                last_written_time = None
+            # Only update our current time if there's a file for this month with a timestamp in it
+            current_time = last_times.get(time_string, current_time)
             current_month = time_string
 
         # Adding one second here so we don't repeat the last line of the file when rerunning
@@ -228,22 +479,83 @@ def process_convo(cur, id_list, convo_map, convo_id, outgoing_name, process_atta
 
         line = make_text_log(id_list, outgoing_name, message)
         if line:
-            current_file.write(line + "\n")
+            # Files are only opened once there's something new to add, so finished months are never touched
+            if current_file is None:
+                out_filename = output_dir / f"{convo_name}_{time_string}.txt"
+                current_file = out_filename.open("a", buffering=OUTPUT_BUFFER_SIZE, encoding="utf-8")
+            pending_lines.append(line + "\n")
+            last_written_time = float(int(message_timestamp))
+            if len(pending_lines) >= WRITE_BATCH_SIZE:
+                current_file.writelines(pending_lines)
+                pending_lines.clear()
         if process_attachments:
-            copy_attachments(attachment_path, output_dir, message)
+            copy_attachments(attachment_path, atch_out_dir, message)
     if current_file:
+        current_file.writelines(pending_lines)
         current_file.close()
 
 
+# Each worker process gets its own connection to the decrypted database, opened once by init_worker
+_worker_cursor = None
+
+
+def init_worker(db_filename, key):
+    global _worker_cursor
+    _worker_cursor = connect_db(db_filename, key, read_only=True).cursor()
+
+
+def process_convo_batch(id_list, outgoing_name, process_attachments, attachment_path, base_output_dir, convo_batch):
+    convo_names = dict(convo_batch)
+    _worker_cursor.execute(MESSAGE_QUERY.format(", ".join("?" * len(convo_names))), list(convo_names))
+    for convo_id, rows in groupby(_worker_cursor, key=itemgetter("conversationId")):
+        process_convo(rows, id_list, convo_names[convo_id], outgoing_name, process_attachments, attachment_path, base_output_dir)
+
+
+def make_convo_batches(convo_names):
+    # Conversations sharing an output directory go in the same batch, so their writes never interleave
+    convos_by_name = {}
+    for convo_id, convo_name in convo_names.items():
+        convos_by_name.setdefault(convo_name, []).append((convo_id, convo_name))
+    batch = []
+    for convos in convos_by_name.values():
+        batch.extend(convos)
+        if len(batch) >= CONVO_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def main(key, db_path, outgoing_name, process_attachments, attachment_path, output_dir):
-    with open_db(key, db_path) as cur:
-        cur.execute("select * from conversations;")
-        raw_conversations = cur.fetchall()
-        id_list = {x["e164"]: make_name(x) for x in raw_conversations if x["e164"] is not None}
-        id_list.update({x["uuid"]: make_name(x) for x in raw_conversations if x.get("uuid", None)})
-        convo_map = {x["id"]: make_name(x) for x in raw_conversations}
-        for convo_id in convo_map.keys():
-            process_convo(cur, id_list, convo_map, convo_id, outgoing_name, process_attachments, attachment_path, output_dir)
+    with open_db(key, db_path) as (db_filename, db_key):
+        # We only write to the decrypted copy, never to Signal's own database
+        connection = connect_db(db_filename, db_key, read_only=db_key is not None)
+        try:
+            cur = connection.cursor()
+            raw_conversations = read_conversations(cur)
+            if db_key is None:
+                # Lets each conversation's messages be read in order straight off the index, without a sort.
+                # Only done on the decrypted copy, since we never write to Signal's own database.
+                cur.execute("create index if not exists messages_convo_sent on messages(conversationId, sent_at)")
+        finally:
+            connection.close()
+        id_list = {}
+        convo_names = {}
+        for x in raw_conversations:
+            name = make_name(x)
+            # Names are transliterated once here, so log lines usually hit the ASCII fast path in fast_unidecode
+            display_name = fast_unidecode(name)
+            if x["e164"] is not None:
+                id_list[x["e164"]] = display_name
+            if x.get("uuid", None):
+                id_list[x["uuid"]] = display_name
+            convo_names[x["id"]] = slugify(demojize(name))
+        convo_worker = partial(process_convo_batch, id_list, outgoing_name,
+                               process_attachments, attachment_path, output_dir)
+        with ProcessPoolExecutor(initializer=init_worker, initargs=(db_filename, db_key)) as executor:
+            # Drain the results so any exception raised in a worker surfaces here
+            for _ in executor.map(convo_worker, make_convo_batches(convo_names)):
+                pass
 
 
 if __name__ == "__main__":
@@ -265,10 +577,17 @@ if __name__ == "__main__":
         with open(args.json, 'r') as config:
             resolved_key = json.load(config).get("key")
 
-    if not find_executable('sqlcipher'):
-        parser.error("sqlcipher must be on your path for this script to function")
+    if sqlcipher is None and not which('sqlcipher'):
+        parser.error("sqlcipher3 or pysqlcipher3 must be installed, or sqlcipher must be on your path, for this script to function")
+
+    # Whichever sqlite ends up reading the database has to understand Signal's schema
+    # (and have the JSON functions MESSAGE_QUERY uses, which are built in from 3.38 on)
+    if sqlcipher is not None and version.parse(sqlcipher.sqlite_version) < version.parse('3.43.1'):
+        print("Signal uses a more recent version of sqlite than your sqlcipher3/pysqlcipher3 bindings were built with")
+        print("Upgrade the bindings or rebuild them against a newer SQLCipher, or uninstall them to use the sqlcipher executable instead")
+        parser.error("sqlcipher bindings' sqlite version is too old (<3.43.1)")
 
-    if version.parse(sqlite3.sqlite_version) < version.parse('3.43.1'):
+    if sqlcipher is None and version.parse(sqlite3.sqlite_version) < version.parse('3.43.1'):
         howto_url = "https://shuaib.org/technical-guide/how-to-update-or-upgrade-sqlite3-version-in-python/"
         download_url = "https://www.sqlite.org/download.html"
         print("Signal uses a more recent version of sqlite than you have installed")
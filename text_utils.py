@@ -0,0 +1,47 @@
+import time
+
+from functools import lru_cache
+
+from unidecode import unidecode
+from emoji import get_emoji_regexp, UNICODE_EMOJI
+
+try:
+    import orjson
+except ImportError:
+    # orjson is just faster; the standard library parser gives the same results
+    orjson = None
+
+# The most common non-ASCII punctuation, mapped the same way unidecode would map it
+ASCII_PUNCTUATION = str.maketrans({
+    '\u00a0': ' ',
+    '\u2013': '-',
+    '\u2014': '--',
+    '\u2018': "'",
+    '\u2019': "'",
+    '\u201c': '"',
+    '\u201d': '"',
+    '\u2026': '...',
+})
+
+# demojize looks these up and builds a new replacement closure on every call; do it once here instead
+EMOJI_REGEXP = get_emoji_regexp()
+
+
+def emoji_name(match):
+    return UNICODE_EMOJI[match.group(0)]
+
+
+def fast_demojize(text):
+    # Emoji are never plain ASCII, so most messages can skip demojize entirely
+    return text if text.isascii() else EMOJI_REGEXP.sub(emoji_name, text)
+
+
+def fast_unidecode(text):
+    text = text.translate(ASCII_PUNCTUATION)
+    return text if text.isascii() else unidecode(text)
+
+
+# Cached by whole second, since bursts of messages often share one
+@lru_cache(maxsize=4096)
+def format_log_time(seconds):
+    return time.strftime('[%Y-%m-%d %H:%M:%S]', time.localtime(seconds))